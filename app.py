@@ -4,13 +4,17 @@ Waterless Oil Diffuser Control System for Raspberry Pi 5
 Controls diffuser based on HVAC fan state with configurable duty cycles
 """
 
+import atexit
+import collections
 import json
 import os
+import sched
 import threading
 import time
 import base64
+from dataclasses import dataclass, asdict, fields, is_dataclass
 from datetime import datetime, time as dt_time
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, render_template, request, send_from_directory
 from flask_cors import CORS
 
 try:
@@ -20,6 +24,13 @@ except ImportError:
     WEBPUSH_AVAILABLE = False
     print("Warning: pywebpush not available. Push notifications disabled.")
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    print("Warning: orjson not available. Using stdlib json.")
+
 try:
     from cryptography.hazmat.primitives.asymmetric import ec
 except ImportError:
@@ -137,6 +148,39 @@ except (ImportError, RuntimeError, OSError) as e:
 app = Flask(__name__)
 CORS(app)
 
+def json_default(obj):
+    """Serialize values stdlib json can't handle (matches orjson's datetime output)"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def json_dumps(obj, indent=False):
+    """Serialize obj to JSON bytes, using orjson when available"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, default=json_default).encode('utf-8')
+
+def json_loads(data):
+    """Parse JSON from bytes or str, using orjson when available"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def write_file_atomic(path, data):
+    """Write bytes to path via a fsynced temp file and os.replace (never leaves a partial file)"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def json_response(payload, status=200):
+    """Build a JSON response (replacement for flask.jsonify)"""
+    return app.response_class(json_dumps(payload), status=status, mimetype='application/json')
+
 # GPIO Pin Definitions
 GPIO_PUMP = 25      # Air pump control
 GPIO_FAN = 24       # 12V fan control
@@ -145,6 +189,13 @@ GPIO_HVAC = 16      # HVAC blower fan state (LOW = on, HIGH = off)
 # Configuration file
 CONFIG_FILE = 'config.json'
 HISTORY_FILE = 'history.json'
+CONFIG_SAVE_DEBOUNCE = 2  # Seconds to coalesce config changes into one write
+CONTROL_IDLE_INTERVAL = 60  # Max seconds the control thread sleeps between checks
+HVAC_POLL_INTERVAL = 30  # Seconds between sanity reads of GPIO_HVAC when edge alerts are active
+HISTORY_SAVE_INTERVAL = 300  # Seconds between history appends
+HISTORY_WINDOW = 24 * 3600  # Seconds of HVAC history kept
+HISTORY_MAX_SAMPLES = HISTORY_WINDOW // 5  # 24 hours of 5 second samples
+HISTORY_MAX_FILE_LINES = 2 * HISTORY_MAX_SAMPLES  # Compact after ~2 days of samples
 SUBSCRIPTIONS_FILE = 'subscriptions.json'
 VAPID_FILE = 'vapid.json'
 
@@ -171,52 +222,106 @@ DUTY_CYCLES = {
     '360s_30s': (360, 30),
 }
 
+# /api/duty_cycles response body (DUTY_CYCLES never changes at runtime)
+DUTY_CYCLES_JSON = json_dumps({
+    key: {'on': on, 'off': off, 'label': f'{on}s / {off}s'}
+    for key, (on, off) in DUTY_CYCLES.items()
+})
+
 # Global state
-state = {
-    'enabled': False,
-    'duty_cycle': '60s_120s',
-    'business_hours_enabled': False,
-    'business_hours_start': '09:00',
-    'business_hours_end': '19:00',
-    'oil_usage_rate_ml_per_hour': 10.0,
-    'oil_bottle_capacity_ml': 150.0,
-    'hvac_fan_state': False,
-    'pump_on': False,
-    'fan_on': False,
-    'pump_runtime_minutes': 0,
-    'fan_runtime_minutes': 0,
-    'last_pump_start': None,
-    'last_fan_start': None,
-    'oil_alert_sent': False,
-}
+@dataclass(slots=True)
+class State:
+    """Diffuser settings and live state (saved to config.json, returned by /api/status)"""
+    enabled: bool = False
+    duty_cycle: str = '60s_120s'
+    business_hours_enabled: bool = False
+    business_hours_start: str = '09:00'
+    business_hours_end: str = '19:00'
+    oil_usage_rate_ml_per_hour: float = 10.0
+    oil_bottle_capacity_ml: float = 150.0
+    hvac_fan_state: bool = False
+    pump_on: bool = False
+    fan_on: bool = False
+    pump_runtime_minutes: float = 0
+    fan_runtime_minutes: float = 0
+    last_pump_start: datetime | None = None
+    last_fan_start: datetime | None = None
+    oil_alert_sent: bool = False
+
+STATE_FIELDS = tuple(f.name for f in fields(State))
+state = State()
+
+# Parsed settings, refreshed by refresh_settings_cache() whenever settings change
+duty_cycle_times = DUTY_CYCLES[state.duty_cycle]  # (on_time, off_time)
+business_hours_times = (dt_time(9, 0), dt_time(19, 0))  # (start, end) or None if invalid
 
 # Control flags
+app_initialized = False
 control_thread = None
-last_config_save_time = None  # Track last periodic config save
+last_config_save_time = None  # time.monotonic() of the last periodic config save
+config_saved_hash = None  # hash() of the config.json contents last written
+config_thread = None
+config_save_event = threading.Event()  # Set when state has changes to persist
+config_lock = threading.Lock()  # Serializes save_config() (shares one temp file)
+runtime_last_tick = None  # time.monotonic() of the last runtime counter update
 monitoring_thread = None
 stop_flag = threading.Event()
-hvac_history = []  # List of (timestamp, state) tuples
+state_cond = threading.Condition()  # Notified when HVAC state or settings change
+control_wakeup = False  # Pending wakeup for the control thread (guarded by state_cond)
+control_scheduler = sched.scheduler(time.monotonic)  # Timed control steps, run by the control thread
+
+state_lock = threading.RLock()  # Guards state (shared by the monitor, control and Flask threads)
+
+# Duty cycle state (only touched from the control thread)
+hvac_detected_time = None  # time.monotonic() when the HVAC fan was seen turning on
+duty_cycle_event = None  # Pending scheduler event for the next duty cycle step
+duty_phase_on = None  # True/False during on/off phases, None when stopped
+duty_phase_start = None  # time.monotonic() when the current phase started
+hvac_history = collections.deque(maxlen=HISTORY_MAX_SAMPLES)  # (epoch seconds, state) tuples
+history_cache = {'json': None, 'dirty': True}  # Serialized /api/history body (guarded by history_lock)
+history_thread = None
+history_unsaved = []  # Samples not yet appended to HISTORY_FILE
+history_lock = threading.Lock()
+history_file = None  # Append-mode handle for HISTORY_FILE (one JSON sample per line)
+history_file_lines = 0  # Lines in HISTORY_FILE since it was last compacted
 
 # GPIO device objects
 gpio_pump = None
 gpio_fan = None
 gpio_hvac = None
 lgpio_handle = None  # lgpio handle for direct pin configuration
+hvac_callback = None  # lgpio edge callback for GPIO_HVAC
+hvac_reader = lambda: True  # Returns True if the HVAC fan is on; bound by init_gpio() (mock: always on)
 
 def load_config():
     """Load configuration from file"""
-    global state
     if os.path.exists(CONFIG_FILE):
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                saved_state = json.load(f)
-                state.update(saved_state)
+            with open(CONFIG_FILE, 'rb') as f:
+                saved_state = json_loads(f.read())
+                for key, value in saved_state.items():
+                    if key in STATE_FIELDS:
+                        setattr(state, key, value)
                 print(f"Loaded config: {saved_state}")
         except Exception as e:
             print(f"Error loading config: {e}")
-    # Ensure new keys exist
-    if 'oil_alert_sent' not in state:
-        state['oil_alert_sent'] = False
+    # Outputs always start off (GPIO initial_value=False), whatever was saved
+    state.pump_on = False
+    state.fan_on = False
+    state.last_pump_start = None
+    state.last_fan_start = None
+    refresh_settings_cache()
+
+def refresh_settings_cache():
+    """Parse duty cycle and business hours settings once instead of on every check"""
+    global duty_cycle_times, business_hours_times
+    duty_cycle_times = DUTY_CYCLES.get(state.duty_cycle, (60, 120))
+    try:
+        business_hours_times = (dt_time.fromisoformat(state.business_hours_start),
+                                dt_time.fromisoformat(state.business_hours_end))
+    except (ValueError, TypeError) as e:
+        print(f"Error parsing business hours: {e}")
+        business_hours_times = None
 
 def base64url_encode(data: bytes) -> str:
     return base64.urlsafe_b64encode(data).rstrip(b'=').decode('utf-8')
@@ -242,8 +347,8 @@ def load_vapid_keys():
     global vapid_private_key, vapid_public_key
     if os.path.exists(VAPID_FILE):
         try:
-            with open(VAPID_FILE) as f:
-                data = json.load(f)
+            with open(VAPID_FILE, 'rb') as f:
+                data = json_loads(f.read())
                 vapid_private_key = data.get('privateKey')
                 vapid_public_key = data.get('publicKey')
                 if vapid_private_key and vapid_public_key:
@@ -256,8 +361,7 @@ def load_vapid_keys():
             keys = generate_vapid_keys()
             vapid_private_key = keys['privateKey']
             vapid_public_key = keys['publicKey']
-            with open(VAPID_FILE, 'w') as f:
-                json.dump(keys, f, indent=2)
+            write_file_atomic(VAPID_FILE, json_dumps(keys, indent=True))
             print("Generated new VAPID keys")
         except Exception as e:
             print(f"Error generating VAPID keys: {e}")
@@ -269,8 +373,8 @@ def load_subscriptions():
     global subscriptions
     if os.path.exists(SUBSCRIPTIONS_FILE):
         try:
-            with open(SUBSCRIPTIONS_FILE) as f:
-                subscriptions = json.load(f)
+            with open(SUBSCRIPTIONS_FILE, 'rb') as f:
+                subscriptions = json_loads(f.read())
                 print(f"Loaded {len(subscriptions)} subscriptions")
         except Exception as e:
             print(f"Error loading subscriptions: {e}")
@@ -279,8 +383,7 @@ def load_subscriptions():
 def save_subscriptions():
     """Persist push subscriptions"""
     try:
-        with open(SUBSCRIPTIONS_FILE, 'w') as f:
-            json.dump(subscriptions, f)
+        write_file_atomic(SUBSCRIPTIONS_FILE, json_dumps(subscriptions))
     except Exception as e:
         print(f"Error saving subscriptions: {e}")
 
@@ -290,7 +393,7 @@ def send_push_notification(title, body):
         return
     if not subscriptions:
         return
-    message = json.dumps({"title": title, "body": body, "url": "/"})
+    message = json_dumps({"title": title, "body": body, "url": "/"})
     to_remove = []
     for sub in subscriptions:
         try:
@@ -313,40 +416,105 @@ def send_push_notification(title, body):
         save_subscriptions()
 
 def save_config():
-    """Save configuration to file"""
-    try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        print(f"Error saving config: {e}")
+    """Save configuration to file (skipped if unchanged since the last save)"""
+    global config_saved_hash
+    with config_lock:
+        try:
+            with state_lock:
+                data = json_dumps(state, indent=True)
+            data_hash = hash(data)
+            if data_hash == config_saved_hash:
+                return
+            write_file_atomic(CONFIG_FILE, data)
+            config_saved_hash = data_hash
+        except Exception as e:
+            print(f"Error saving config: {e}")
+
+def request_config_save():
+    """Schedule a debounced save_config() on the config save thread"""
+    config_save_event.set()
+
+def config_save_thread():
+    """Save config at most every CONFIG_SAVE_DEBOUNCE seconds after changes"""
+    while not stop_flag.is_set():
+        config_save_event.wait()
+        # Let a burst of changes settle into a single write
+        stop_flag.wait(CONFIG_SAVE_DEBOUNCE)
+        config_save_event.clear()
+        save_config()
 
 def load_history():
-    """Load HVAC history from file"""
+    """Load HVAC history from file (one JSON sample per line)"""
     global hvac_history
     if os.path.exists(HISTORY_FILE):
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                data = json.load(f)
-                hvac_history = [(datetime.fromisoformat(ts), s) for ts, s in data]
+            entries = []
+            with open(HISTORY_FILE, 'rb') as f:
+                if f.read(1) == b'[':
+                    # Legacy format: a single JSON list of [timestamp, state] pairs
+                    f.seek(0)
+                    entries = [(datetime.fromisoformat(ts).timestamp(), s) for ts, s in json_loads(f.read())]
+                else:
+                    f.seek(0)
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            sample = json_loads(line)
+                            entries.append((datetime.fromisoformat(sample['ts']).timestamp(), sample['s']))
+                        except (ValueError, KeyError, TypeError):
+                            # Skip a torn line left by an interrupted append
+                            continue
+            cutoff = time.time() - HISTORY_WINDOW
+            hvac_history = collections.deque(((ts, s) for ts, s in entries if ts > cutoff),
+                                             maxlen=HISTORY_MAX_SAMPLES)
+            with history_lock:
+                history_cache['dirty'] = True
+                compact_history_file()
         except Exception as e:
             print(f"Error loading history: {e}")
 
+def format_history_line(ts, s):
+    """Serialize one history sample as a line of HISTORY_FILE"""
+    return json_dumps({'ts': datetime.fromtimestamp(ts).isoformat(), 's': s}) + b'\n'
+
+def compact_history_file():
+    """Rewrite HISTORY_FILE with only the in-memory history (caller holds history_lock)"""
+    global history_file, history_file_lines
+    if history_file is not None:
+        history_file.close()
+        history_file = None
+    cutoff = time.time() - HISTORY_WINDOW
+    lines = [format_history_line(ts, s) for ts, s in hvac_history if ts > cutoff]
+    write_file_atomic(HISTORY_FILE, b''.join(lines))
+    history_unsaved.clear()
+    history_file_lines = len(lines)
+
 def save_history():
-    """Save HVAC history to file (keep last 24 hours)"""
-    try:
-        # Keep only last 24 hours
-        cutoff = datetime.now().timestamp() - (24 * 3600)
-        recent_history = [(ts.isoformat(), s) for ts, s in hvac_history 
-                         if ts.timestamp() > cutoff]
-        
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(recent_history, f, indent=2)
-    except Exception as e:
-        print(f"Error saving history: {e}")
+    """Append unsaved HVAC history samples to file"""
+    global history_file, history_file_lines
+    with history_lock:
+        if not history_unsaved:
+            return
+        try:
+            if history_file_lines + len(history_unsaved) > HISTORY_MAX_FILE_LINES:
+                # Drop samples older than 24 hours from the file
+                compact_history_file()
+                return
+            if history_file is None:
+                history_file = open(HISTORY_FILE, 'ab')
+            for ts, s in history_unsaved:
+                history_file.write(format_history_line(ts, s))
+            history_file.flush()
+            history_file_lines += len(history_unsaved)
+            history_unsaved.clear()
+        except Exception as e:
+            print(f"Error saving history: {e}")
 
 def init_gpio():
     """Initialize GPIO pins"""
-    global gpio_pump, gpio_fan, gpio_hvac, GPIO_AVAILABLE, lgpio_handle
+    global gpio_pump, gpio_fan, gpio_hvac, GPIO_AVAILABLE, lgpio_handle, hvac_callback, hvac_reader
     
     if not GPIO_AVAILABLE:
         return
@@ -362,8 +530,14 @@ def init_gpio():
             import lgpio
             handle = lgpio.gpiochip_open(0)
             
-            # Claim GPIO16 as input
-            lgpio.gpio_claim_input(handle, GPIO_HVAC)
+            # Claim GPIO16 as input with edge alerts so state changes are pushed to us
+            try:
+                lgpio.gpio_claim_alert(handle, GPIO_HVAC, lgpio.BOTH_EDGES)
+                edge_alerts = True
+            except Exception as e:
+                print(f"Warning: Could not enable GPIO{GPIO_HVAC} edge alerts ({e}), polling instead")
+                lgpio.gpio_claim_input(handle, GPIO_HVAC)
+                edge_alerts = False
             
             # Set GPIO16 to no pull resistor
             try:
@@ -383,6 +557,14 @@ def init_gpio():
             lgpio_handle = handle
             gpio_hvac = None  # We'll use lgpio directly for reading
             print(f"GPIO{GPIO_HVAC} configured, will use lgpio directly for reading")
+            
+            # Bind the read function and handle once so each read is a single C call
+            gpio_read = lgpio.gpio_read
+            hvac_reader = lambda: gpio_read(handle, GPIO_HVAC) == 0  # LOW = on
+            
+            if edge_alerts:
+                hvac_callback = lgpio.callback(handle, GPIO_HVAC, lgpio.BOTH_EDGES, on_hvac_edge)
+                print(f"GPIO{GPIO_HVAC} edge callback registered")
         except ImportError:
             # lgpio not available, try with gpiozero's pull parameter
             print("lgpio not available, trying gpiozero pull parameter...")
@@ -394,6 +576,8 @@ def init_gpio():
                 factory = NativeFactory()
                 gpio_hvac = InputDevice(GPIO_HVAC, pull=None, pin_factory=factory)
             lgpio_handle = None
+            hvac_device = gpio_hvac
+            hvac_reader = lambda: hvac_device.value == 0  # gpiozero value 0 = LOW = on
         
         print(f"GPIO initialized: Pump={GPIO_PUMP}, Fan={GPIO_FAN}, HVAC={GPIO_HVAC}")
     except Exception as e:
@@ -402,8 +586,11 @@ def init_gpio():
 
 def cleanup_gpio():
     """Cleanup GPIO pins"""
-    global gpio_pump, gpio_fan, gpio_hvac, lgpio_handle
+    global gpio_pump, gpio_fan, gpio_hvac, lgpio_handle, hvac_callback
     
+    if hvac_callback is not None:
+        hvac_callback.cancel()
+        hvac_callback = None
     if gpio_pump:
         gpio_pump.close()
         gpio_pump = None
@@ -423,309 +610,301 @@ def cleanup_gpio():
 
 def is_business_hours():
     """Check if current time is within business hours"""
-    if not state['business_hours_enabled']:
+    if not state.business_hours_enabled or business_hours_times is None:
         return True
     
-    try:
-        start_time = dt_time.fromisoformat(state['business_hours_start'])
-        end_time = dt_time.fromisoformat(state['business_hours_end'])
-        current_time = datetime.now().time()
-        
-        if start_time <= end_time:
-            return start_time <= current_time <= end_time
-        else:  # Span midnight
-            return current_time >= start_time or current_time <= end_time
-    except Exception as e:
-        print(f"Error checking business hours: {e}")
-        return True
+    start_time, end_time = business_hours_times
+    current_time = datetime.now().time()
+    
+    if start_time <= end_time:
+        return start_time <= current_time <= end_time
+    else:  # Span midnight
+        return current_time >= start_time or current_time <= end_time
 
 def update_runtime_counters():
-    """Update runtime counters based on current state"""
-    now = datetime.now()
-    
-    if state['pump_on']:
-        if state['last_pump_start']:
-            # Accumulate time since last check (1 second intervals)
-            elapsed = 1.0 / 60.0  # 1 second in minutes
-            state['pump_runtime_minutes'] += elapsed
-        else:
-            # Just turned on, record start time
-            state['last_pump_start'] = now
-    else:
-        # Just turned off, clear start time
-        if state['last_pump_start']:
-            state['last_pump_start'] = None
-    
-    if state['fan_on']:
-        if state['last_fan_start']:
-            # Accumulate time since last check (1 second intervals)
-            elapsed = 1.0 / 60.0  # 1 second in minutes
-            state['fan_runtime_minutes'] += elapsed
-        else:
-            # Just turned on, record start time
-            state['last_fan_start'] = now
-    else:
-        # Just turned off, clear start time
-        if state['last_fan_start']:
-            state['last_fan_start'] = None
+    """Add the time since the last update to the runtime of whatever is on"""
+    global runtime_last_tick
+    with state_lock:
+        now = time.monotonic()
+        elapsed = (now - runtime_last_tick) / 60.0 if runtime_last_tick is not None else 0.0  # minutes
+        runtime_last_tick = now
+        
+        if state.pump_on:
+            state.pump_runtime_minutes += elapsed
+        if state.fan_on:
+            state.fan_runtime_minutes += elapsed
 
 def set_pump(on):
     """Control the air pump"""
     global gpio_pump
     
-    if state['pump_on'] == on:
-        return  # No change needed
-    
-    if GPIO_AVAILABLE and gpio_pump:
-        if on:
-            gpio_pump.on()
-        else:
-            gpio_pump.off()
-    
-    state['pump_on'] = on
-    if on and not state['last_pump_start']:
-        state['last_pump_start'] = datetime.now()
+    with state_lock:
+        if state.pump_on == on:
+            return  # No change needed
+        
+        # Close out runtime accumulated in the previous state
+        update_runtime_counters()
+        
+        if GPIO_AVAILABLE and gpio_pump:
+            if on:
+                gpio_pump.on()
+            else:
+                gpio_pump.off()
+        
+        state.pump_on = on
+        state.last_pump_start = datetime.now() if on else None
 
 def set_fan(on):
     """Control the 12V fan"""
     global gpio_fan
     
-    if state['fan_on'] == on:
-        return  # No change needed
-    
-    if GPIO_AVAILABLE and gpio_fan:
-        if on:
-            gpio_fan.on()
-        else:
-            gpio_fan.off()
-    
-    state['fan_on'] = on
-    if on and not state['last_fan_start']:
-        state['last_fan_start'] = datetime.now()
+    with state_lock:
+        if state.fan_on == on:
+            return  # No change needed
+        
+        # Close out runtime accumulated in the previous state
+        update_runtime_counters()
+        
+        if GPIO_AVAILABLE and gpio_fan:
+            if on:
+                gpio_fan.on()
+            else:
+                gpio_fan.off()
+        
+        state.fan_on = on
+        state.last_fan_start = datetime.now() if on else None
+
+def set_diffuser(on):
+    """Switch the air pump and fan together (no GPIO writes if already in that state)"""
+    set_pump(on)
+    set_fan(on)
 
 def read_hvac_state():
     """Read HVAC blower fan state (LOW = on, HIGH = off)"""
-    global gpio_hvac, lgpio_handle
-    
-    if GPIO_AVAILABLE:
-        if gpio_hvac:
-            # Use gpiozero to read
-            # gpiozero: value is 0 for LOW, 1 for HIGH
-            # LOW (0) means HVAC fan is on
-            return gpio_hvac.value == 0
-        elif lgpio_handle is not None:
-            # Use lgpio directly to read
-            try:
-                import lgpio
-                raw_value = lgpio.gpio_read(lgpio_handle, GPIO_HVAC)
-                return raw_value == 0  # LOW = on
-            except:
-                return False
-    else:
-        # Mock: return True for testing
-        return True
+    return hvac_reader()
+
+def update_hvac_state(hvac_state):
+    """Record the HVAC fan state and wake the control thread if it changed"""
+    with state_lock:
+        if hvac_state == state.hvac_fan_state:
+            return
+        state.hvac_fan_state = hvac_state
+    notify_control()
+
+def on_hvac_edge(chip, gpio, level, tick):
+    """lgpio callback for GPIO_HVAC edges (LOW = on, HIGH = off)"""
+    if level in (0, 1):  # 2 is a watchdog timeout, not a level change
+        update_hvac_state(level == 0)
 
 def hvac_monitoring_thread():
-    """Monitor HVAC fan state every 5 seconds"""
-    global hvac_history
-    
-    hvac_detected = False
-    hvac_detected_time = None
+    """Record HVAC fan state every 5 seconds"""
+    last_read_time = None  # time.monotonic() of the last pin read
     
     while not stop_flag.is_set():
         try:
-            hvac_state = read_hvac_state()
-            state['hvac_fan_state'] = hvac_state
+            # Changes normally arrive through on_hvac_edge; re-read the pin as a
+            # sanity check, or on every sample when edge alerts are unavailable
+            tick = time.monotonic()
+            if hvac_callback is None or last_read_time is None or tick - last_read_time >= HVAC_POLL_INTERVAL:
+                update_hvac_state(read_hvac_state())
+                last_read_time = tick
             
-            # Record history
-            hvac_history.append((datetime.now(), hvac_state))
-            
-            # Keep only last 24 hours in memory
-            cutoff = datetime.now().timestamp() - (24 * 3600)
-            hvac_history = [(ts, s) for ts, s in hvac_history 
-                           if ts.timestamp() > cutoff]
-            
-            # Save history periodically (every 5 minutes)
-            if len(hvac_history) % 60 == 0:
-                save_history()
-            
-            # Detect HVAC fan turning on
-            if hvac_state and not hvac_detected:
-                hvac_detected = True
-                hvac_detected_time = time.time()
-            elif not hvac_state:
-                hvac_detected = False
-                hvac_detected_time = None
+            # Record history (persisted by save_history_thread); wall clock for the chart
+            sample = (time.time(), state.hvac_fan_state)
+            with history_lock:
+                hvac_history.append(sample)
+                history_unsaved.append(sample)
+                history_cache['dirty'] = True
             
             time.sleep(5)
         except Exception as e:
             print(f"Error in HVAC monitoring: {e}")
             time.sleep(5)
 
+def save_history_thread():
+    """Append new HVAC history samples to file every HISTORY_SAVE_INTERVAL seconds"""
+    while not stop_flag.wait(HISTORY_SAVE_INTERVAL):
+        save_history()
+
 def calculate_oil_remaining():
     """Calculate remaining oil percentage"""
-    pump_runtime_hours = state['pump_runtime_minutes'] / 60.0
-    oil_used_ml = pump_runtime_hours * state['oil_usage_rate_ml_per_hour']
-    oil_remaining_ml = max(0, state['oil_bottle_capacity_ml'] - oil_used_ml)
-    oil_percentage = (oil_remaining_ml / state['oil_bottle_capacity_ml'] * 100) if state['oil_bottle_capacity_ml'] > 0 else 0
+    pump_runtime_hours = state.pump_runtime_minutes / 60.0
+    oil_used_ml = pump_runtime_hours * state.oil_usage_rate_ml_per_hour
+    oil_remaining_ml = max(0, state.oil_bottle_capacity_ml - oil_used_ml)
+    oil_percentage = (oil_remaining_ml / state.oil_bottle_capacity_ml * 100) if state.oil_bottle_capacity_ml > 0 else 0
     return oil_percentage, oil_remaining_ml
 
+def wait_for_control_event(timeout):
+    """Block the control thread until notify_control() is called or timeout expires"""
+    global control_wakeup
+    with state_cond:
+        if not control_wakeup:
+            state_cond.wait(timeout=max(0, timeout))
+        woken = control_wakeup
+        control_wakeup = False
+    return woken
+
+def notify_control():
+    """Wake the control thread to re-evaluate the diffuser state"""
+    global control_wakeup
+    with state_cond:
+        control_wakeup = True
+        state_cond.notify_all()
+
+def schedule_duty_step(delay, action):
+    """Replace the pending duty cycle step with action, delay seconds from now"""
+    global duty_cycle_event
+    cancel_duty_step()
+    duty_cycle_event = control_scheduler.enter(delay, 1, action)
+
+def cancel_duty_step():
+    """Cancel the pending duty cycle step, if any"""
+    global duty_cycle_event
+    if duty_cycle_event is not None:
+        try:
+            control_scheduler.cancel(duty_cycle_event)
+        except ValueError:
+            pass  # Already ran
+        duty_cycle_event = None
+
+def start_on_phase():
+    """Turn the diffuser on and schedule the off phase"""
+    global duty_phase_on, duty_phase_start
+    duty_phase_on = True
+    duty_phase_start = time.monotonic()
+    set_diffuser(True)
+    schedule_duty_step(duty_cycle_times[0], start_off_phase)
+
+def start_off_phase():
+    """Turn the diffuser off and schedule the next on phase"""
+    global duty_phase_on, duty_phase_start
+    duty_phase_on = False
+    duty_phase_start = time.monotonic()
+    set_diffuser(False)
+    schedule_duty_step(duty_cycle_times[1], start_on_phase)
+
+def stop_duty_cycle():
+    """Cancel any scheduled duty cycle steps and turn the diffuser off"""
+    global duty_phase_on, duty_phase_start
+    cancel_duty_step()
+    duty_phase_on = None
+    duty_phase_start = None
+    set_diffuser(False)
+
+def evaluate_control():
+    """Check oil, enable, business hours and HVAC state, then start or stop the duty cycle"""
+    global last_config_save_time, hvac_detected_time
+    
+    # One clock read per pass; monotonic so clock syncs cannot stall the duty cycle
+    now = time.monotonic()
+    
+    # Periodic config save (every 4 hours) to protect against power loss
+    if last_config_save_time is None:
+        last_config_save_time = now
+    elif now - last_config_save_time >= 4 * 3600:  # 4 hours in seconds
+        save_config()
+        last_config_save_time = now
+        print(f"Periodic config save completed at {datetime.now().isoformat()}")
+    
+    with state_lock:
+        # Bring runtime counters up to date for the oil level check
+        update_runtime_counters()
+        
+        # Check oil level - automatically disable if at 0%
+        oil_percentage, oil_remaining_ml = calculate_oil_remaining()
+        send_oil_alert = False
+        if oil_percentage <= 0:
+            if not state.oil_alert_sent:
+                state.oil_alert_sent = True
+                send_oil_alert = True
+                request_config_save()
+            if state.enabled:
+                # Oil depleted - automatically disable system
+                state.enabled = False
+                request_config_save()
+                print(f"System automatically disabled: Oil depleted (0% remaining, {oil_remaining_ml:.1f} ml)")
+        else:
+            if state.oil_alert_sent:
+                state.oil_alert_sent = False
+                request_config_save()
+        
+        hvac_on = state.hvac_fan_state
+        should_run = state.enabled and is_business_hours()
+    
+    # Send outside the lock, it goes out over the network
+    if send_oil_alert:
+        send_push_notification(
+            "Aroma System",
+            "Oil tank is empty. The system has been disabled until it is refilled."
+        )
+    
+    # Track when the HVAC fan turned on
+    if not hvac_on:
+        hvac_detected_time = None
+    elif hvac_detected_time is None:
+        hvac_detected_time = now
+    
+    if not should_run or hvac_detected_time is None:
+        stop_duty_cycle()
+    elif duty_phase_on is None:
+        # Start the duty cycle 10 seconds after detecting the HVAC fan
+        schedule_duty_step(max(0, hvac_detected_time + 10 - now), start_on_phase)
+    else:
+        # Re-time the current phase in case the duty cycle setting changed
+        on_time, off_time = duty_cycle_times
+        phase_end = duty_phase_start + (on_time if duty_phase_on else off_time)
+        schedule_duty_step(max(0, phase_end - now), start_off_phase if duty_phase_on else start_on_phase)
+
+def periodic_control_check():
+    """Re-evaluate every CONTROL_IDLE_INTERVAL seconds for business hours and oil level"""
+    control_scheduler.enter(CONTROL_IDLE_INTERVAL, 2, periodic_control_check)
+    evaluate_control()
+
 def control_thread_func():
-    """Main control thread for diffuser operation"""
-    hvac_detected = False
-    hvac_detected_time = None
-    pump_on = False
-    fan_on = False
-    duty_cycle_start = None
-    on_phase = True
+    """Main control thread: runs scheduled duty cycle steps, re-evaluating on notify"""
+    control_scheduler.enter(0, 2, periodic_control_check)
     
     while not stop_flag.is_set():
         try:
-            # Update runtime counters
-            update_runtime_counters()
-            
-            # Periodic config save (every 4 hours) to protect against power loss
-            global last_config_save_time
-            now = time.time()
-            if last_config_save_time is None:
-                last_config_save_time = now
-            elif now - last_config_save_time >= 4 * 3600:  # 4 hours in seconds
-                save_config()
-                last_config_save_time = now
-                print(f"Periodic config save completed at {datetime.now().isoformat()}")
-            
-            # Check oil level - automatically disable if at 0%
-            oil_percentage, oil_remaining_ml = calculate_oil_remaining()
-            if oil_percentage <= 0:
-                if not state.get('oil_alert_sent'):
-                    state['oil_alert_sent'] = True
-                    save_config()
-                    send_push_notification(
-                        "Aroma System",
-                        "Oil tank is empty. The system has been disabled until it is refilled."
-                    )
-                if state['enabled']:
-                    # Oil depleted - automatically disable system
-                    state['enabled'] = False
-                    save_config()
-                    if pump_on or fan_on:
-                        set_pump(False)
-                        set_fan(False)
-                        pump_on = False
-                        fan_on = False
-                        duty_cycle_start = None
-                    print(f"System automatically disabled: Oil depleted (0% remaining, {oil_remaining_ml:.1f} ml)")
-            else:
-                if state.get('oil_alert_sent'):
-                    state['oil_alert_sent'] = False
-                    save_config()
-            
-            # Check if system is enabled
-            if not state['enabled']:
-                if pump_on or fan_on:
-                    set_pump(False)
-                    set_fan(False)
-                    pump_on = False
-                    fan_on = False
-                    duty_cycle_start = None
-                time.sleep(1)
-                continue
-            
-            # Check business hours
-            if not is_business_hours():
-                if pump_on or fan_on:
-                    set_pump(False)
-                    set_fan(False)
-                    pump_on = False
-                    fan_on = False
-                    duty_cycle_start = None
-                time.sleep(1)
-                continue
-            
-            # Check HVAC state
-            hvac_state = state['hvac_fan_state']
-            
-            if hvac_state:
-                if not hvac_detected:
-                    hvac_detected = True
-                    hvac_detected_time = time.time()
-                
-                # Wait 10 seconds after detecting HVAC fan
-                if hvac_detected_time and (time.time() - hvac_detected_time) >= 10:
-                    # Get current duty cycle
-                    on_time, off_time = DUTY_CYCLES.get(state['duty_cycle'], (60, 120))
-                    
-                    if duty_cycle_start is None:
-                        duty_cycle_start = time.time()
-                        on_phase = True
-                    
-                    elapsed = time.time() - duty_cycle_start
-                    
-                    if on_phase:
-                        if elapsed >= on_time:
-                            # Switch to off phase
-                            on_phase = False
-                            duty_cycle_start = time.time()
-                            set_pump(False)
-                            set_fan(False)
-                            pump_on = False
-                            fan_on = False
-                        else:
-                            # Keep pump and fan on
-                            if not pump_on or not fan_on:
-                                set_pump(True)
-                                set_fan(True)
-                                pump_on = True
-                                fan_on = True
-                    else:
-                        if elapsed >= off_time:
-                            # Switch to on phase
-                            on_phase = True
-                            duty_cycle_start = time.time()
-                        else:
-                            # Keep pump and fan off
-                            if pump_on or fan_on:
-                                set_pump(False)
-                                set_fan(False)
-                                pump_on = False
-                                fan_on = False
-                else:
-                    # Still waiting for 10 second delay
-                    if pump_on or fan_on:
-                        set_pump(False)
-                        set_fan(False)
-                        pump_on = False
-                        fan_on = False
-                    duty_cycle_start = None
-            else:
-                # HVAC fan is off
-                hvac_detected = False
-                hvac_detected_time = None
-                if pump_on or fan_on:
-                    set_pump(False)
-                    set_fan(False)
-                    pump_on = False
-                    fan_on = False
-                duty_cycle_start = None
-            
-            time.sleep(1)
+            # Run due steps; returns seconds until the next one
+            delay = control_scheduler.run(blocking=False)
         except Exception as e:
             print(f"Error in control thread: {e}")
-            time.sleep(1)
+            delay = 1
+        
+        if wait_for_control_event(delay if delay is not None else CONTROL_IDLE_INTERVAL):
+            # HVAC state or settings changed
+            control_scheduler.enter(0, 0, evaluate_control)
 
 def start_threads():
     """Start monitoring and control threads"""
-    global monitoring_thread, control_thread
+    global monitoring_thread, control_thread, history_thread, config_thread
     
     if monitoring_thread is None or not monitoring_thread.is_alive():
         monitoring_thread = threading.Thread(target=hvac_monitoring_thread, daemon=True)
         monitoring_thread.start()
     
+    if history_thread is None or not history_thread.is_alive():
+        history_thread = threading.Thread(target=save_history_thread, daemon=True)
+        history_thread.start()
+    
+    if config_thread is None or not config_thread.is_alive():
+        config_thread = threading.Thread(target=config_save_thread, daemon=True)
+        config_thread.start()
+    
     if control_thread is None or not control_thread.is_alive():
         control_thread = threading.Thread(target=control_thread_func, daemon=True)
         control_thread.start()
 
 # Flask Routes
+@app.after_request
+def add_etag(response):
+    """Tag GET /api/ responses so clients polling unchanged data get a 304"""
+    if request.method == 'GET' and request.path.startswith('/api/') and response.status_code == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
 @app.route('/')
 def index():
     """Serve main page"""
@@ -744,133 +923,143 @@ def manifest():
 @app.route('/api/status')
 def get_status():
     """Get current system status"""
-    update_runtime_counters()
+    # Snapshot under the lock, serialize outside it
+    with state_lock:
+        update_runtime_counters()
+        status = {name: getattr(state, name) for name in STATE_FIELDS}
+        oil_percentage, oil_remaining_ml = calculate_oil_remaining()
     
-    # Calculate oil remaining using helper function
-    oil_percentage, oil_remaining_ml = calculate_oil_remaining()
-    pump_runtime_hours = state['pump_runtime_minutes'] / 60.0
-    oil_used_ml = pump_runtime_hours * state['oil_usage_rate_ml_per_hour']
-    
-    status = state.copy()
+    oil_used_ml = status['pump_runtime_minutes'] / 60.0 * status['oil_usage_rate_ml_per_hour']
     status['oil_remaining_ml'] = round(oil_remaining_ml, 1)
     status['oil_percentage'] = round(oil_percentage, 1)
     status['oil_used_ml'] = round(oil_used_ml, 1)
-    
-    return jsonify(status)
+    return json_response(status)
 
 @app.route('/api/history')
 def get_history():
     """Get HVAC history for last 24 hours"""
-    cutoff = datetime.now().timestamp() - (24 * 3600)
-    recent_history = [(ts.isoformat(), s) for ts, s in hvac_history 
-                     if ts.timestamp() > cutoff]
-    return jsonify(recent_history)
+    with history_lock:
+        if history_cache['dirty']:
+            # Rebuild only after the monitoring thread has recorded new samples
+            cutoff = time.time() - HISTORY_WINDOW
+            history_cache['json'] = json_dumps([(datetime.fromtimestamp(ts).isoformat(), s)
+                                                for ts, s in hvac_history if ts > cutoff])
+            history_cache['dirty'] = False
+        body = history_cache['json']
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/api/vapid-public-key')
 def get_vapid_public_key():
     """Return VAPID public key for push subscriptions"""
     if not WEBPUSH_AVAILABLE or not vapid_public_key:
-        return jsonify({'error': 'Push notifications not configured'}), 503
-    return jsonify({'publicKey': vapid_public_key})
+        return json_response({'error': 'Push notifications not configured'}, 503)
+    return json_response({'publicKey': vapid_public_key})
 
 @app.route('/api/subscribe', methods=['POST'])
 def subscribe():
     """Store push subscription"""
     global subscriptions
     if not WEBPUSH_AVAILABLE:
-        return jsonify({'error': 'Push not available on server'}), 503
+        return json_response({'error': 'Push not available on server'}, 503)
     subscription = request.json
     if not subscription or 'endpoint' not in subscription:
         print("Error: Invalid subscription received")
-        return jsonify({'error': 'Invalid subscription'}), 400
+        return json_response({'error': 'Invalid subscription'}, 400)
     if subscription not in subscriptions:
         subscriptions.append(subscription)
         save_subscriptions()
         print(f"New push subscription ({len(subscriptions)} total)")
     else:
         print("Received existing subscription")
-    return jsonify({'success': True})
+    return json_response({'success': True})
 
 @app.route('/api/test_notification', methods=['POST'])
 def test_notification():
     """Send test notification to all subscribers"""
     send_push_notification("Aroma System Test", "This is a test notification from the control panel.")
-    return jsonify({'success': True})
+    return json_response({'success': True})
 
 @app.route('/api/duty_cycles')
 def get_duty_cycles():
     """Get available duty cycles"""
-    cycles = {}
-    for key, (on, off) in DUTY_CYCLES.items():
-        cycles[key] = {
-            'on': on,
-            'off': off,
-            'label': f'{on}s / {off}s'
-        }
-    return jsonify(cycles)
+    return app.response_class(DUTY_CYCLES_JSON, mimetype='application/json')
 
 @app.route('/api/settings', methods=['POST'])
 def update_settings():
     """Update system settings"""
     data = request.json
     
-    if 'enabled' in data:
-        state['enabled'] = bool(data['enabled'])
-    
-    if 'duty_cycle' in data:
-        if data['duty_cycle'] in DUTY_CYCLES:
-            state['duty_cycle'] = data['duty_cycle']
-    
-    if 'business_hours_enabled' in data:
-        state['business_hours_enabled'] = bool(data['business_hours_enabled'])
-    
-    if 'business_hours_start' in data:
-        state['business_hours_start'] = data['business_hours_start']
-    
-    if 'business_hours_end' in data:
-        state['business_hours_end'] = data['business_hours_end']
-    
-    if 'oil_usage_rate_ml_per_hour' in data:
-        try:
-            state['oil_usage_rate_ml_per_hour'] = float(data['oil_usage_rate_ml_per_hour'])
-        except (ValueError, TypeError):
-            pass
-    
-    if 'oil_bottle_capacity_ml' in data:
-        try:
-            state['oil_bottle_capacity_ml'] = float(data['oil_bottle_capacity_ml'])
-        except (ValueError, TypeError):
-            pass
-    
-    save_config()
-    return jsonify({'success': True, 'state': state})
+    with state_lock:
+        if 'enabled' in data:
+            state.enabled = bool(data['enabled'])
+        
+        if 'duty_cycle' in data:
+            if data['duty_cycle'] in DUTY_CYCLES:
+                state.duty_cycle = data['duty_cycle']
+        
+        if 'business_hours_enabled' in data:
+            state.business_hours_enabled = bool(data['business_hours_enabled'])
+        
+        if 'business_hours_start' in data:
+            state.business_hours_start = data['business_hours_start']
+        
+        if 'business_hours_end' in data:
+            state.business_hours_end = data['business_hours_end']
+        
+        if 'oil_usage_rate_ml_per_hour' in data:
+            try:
+                state.oil_usage_rate_ml_per_hour = float(data['oil_usage_rate_ml_per_hour'])
+            except (ValueError, TypeError):
+                pass
+        
+        if 'oil_bottle_capacity_ml' in data:
+            try:
+                state.oil_bottle_capacity_ml = float(data['oil_bottle_capacity_ml'])
+            except (ValueError, TypeError):
+                pass
+        
+        refresh_settings_cache()
+        response = json_response({'success': True, 'state': state})
+    request_config_save()
+    notify_control()
+    return response
 
 @app.route('/api/reset_counters', methods=['POST'])
 def reset_counters():
     """Reset runtime counters"""
-    state['pump_runtime_minutes'] = 0
-    state['fan_runtime_minutes'] = 0
-    state['last_pump_start'] = None
-    state['last_fan_start'] = None
-    state['oil_alert_sent'] = False
+    with state_lock:
+        update_runtime_counters()  # Discard runtime accumulated before the reset
+        state.pump_runtime_minutes = 0
+        state.fan_runtime_minutes = 0
+        state.oil_alert_sent = False
+    request_config_save()
+    return json_response({'success': True})
+
+# WSGI entry point: gunicorn 'app:create_app()' (one worker, since it owns the GPIO pins)
+def create_app():
+    """Initialize state, GPIO and background threads once; returns the Flask app"""
+    global app_initialized
+    if not app_initialized:
+        app_initialized = True
+        load_config()
+        load_history()
+        load_vapid_keys()
+        load_subscriptions()
+        init_gpio()
+        start_threads()
+        atexit.register(shutdown)
+    return app
+
+def shutdown():
+    """Stop background threads, release GPIO and persist state"""
+    stop_flag.set()
+    notify_control()
+    config_save_event.set()
+    cleanup_gpio()
     save_config()
-    return jsonify({'success': True})
+    save_history()
 
 if __name__ == '__main__':
-    # Initialize
-    load_config()
-    load_history()
-    load_vapid_keys()
-    load_subscriptions()
-    init_gpio()
-    start_threads()
-    
-    try:
-        # Run Flask app
-        app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
-    finally:
-        stop_flag.set()
-        cleanup_gpio()
-        save_config()
-        save_history()
-
+    # Development server; production runs under gunicorn (see aroma-pi.service)
+    create_app()
+    app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
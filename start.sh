@@ -11,7 +11,7 @@ if [ ! -d "venv" ]; then
     ./venv/bin/pip install -r requirements.txt
 fi
 
-# Start the application
+# Start the application (single worker: it owns the GPIO pins and background threads)
 echo "Starting Oil Diffuser Control System..."
-./venv/bin/python app.py
+./venv/bin/gunicorn --workers 1 --worker-class gthread --threads 4 --bind 0.0.0.0:8080 'app:create_app()'
 
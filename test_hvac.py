@@ -1,58 +1,142 @@
 #!/usr/bin/env python3
 """
 Test script to read and display HVAC fan state from GPIO16
-Reads the state every 5 seconds and displays it on screen
+Prints the state at startup and on every change (gpiod line events or lgpio edge alerts)
 """
 
+import contextlib
+import selectors
+import threading
 import time
 import sys
+import traceback
+from datetime import timedelta
 
-# GPIO Pin Definition
-GPIO_HVAC = 16  # HVAC blower fan state (LOW = on, HIGH = off)
+# Prefer libgpiod v2: edge events are read from the line request fd on the
+# main thread instead of being delivered on lgpio's callback thread
+try:
+    import gpiod
+    from gpiod.line import Bias, Direction, Edge, Value
+    GPIOD_AVAILABLE = hasattr(gpiod, 'request_lines')  # v1 bindings lack the v2 API
+except ImportError:
+    GPIOD_AVAILABLE = False
 
-# Try to use gpiozero with lgpio
 try:
-    from gpiozero import InputDevice
-    # Try to use lgpio pin factory for Raspberry Pi 5
-    try:
-        from gpiozero.pins.lgpio import LGPIOFactory
-        from gpiozero import Device
-        Device.pin_factory = LGPIOFactory()
-        print("Using lgpio pin factory for Raspberry Pi 5")
-    except (ImportError, Exception) as e:
-        print(f"Note: Using default pin factory ({e})")
-    
-    GPIO_AVAILABLE = True
-except (ImportError, RuntimeError, OSError) as e:
-    print(f"Error: gpiozero not available ({e})")
-    print("Make sure gpiozero and rpi-lgpio are installed")
-    sys.exit(1)
+    import lgpio
+except ImportError as e:
+    lgpio = None
+    if not GPIOD_AVAILABLE:
+        print(f"Error: neither gpiod (v2) nor lgpio available ({e})")
+        print("Make sure python3-lgpio is installed")
+        sys.exit(1)
+
+# GPIO Pin Definition
+GPIO_HVAC = 16  # HVAC blower fan state (LOW = on, HIGH = off)
+GPIOD_CHIP = "/dev/gpiochip0"  # Header GPIO chip (same chip as lgpio.gpiochip_open(0))
+HEARTBEAT_INTERVAL = 3600  # Seconds between re-prints of the last known state (0 = off)
+BOUNCE_MS = 50  # Edges closer together than this are treated as contact bounce
+BOUNCE_US = BOUNCE_MS * 1000
+RAW_LABELS = ("LOW (0) ", "HIGH (1)")  # Indexed by pin value
+STATE_LABELS = ("OFF", "ON ")  # Indexed by is_on
+_FMT = "[{}] #{:4d} | State: {} | Raw: {} | Pin Value: {}{}\n".format  # Status line template
 
 # Global variables
-gpio_hvac = None
-lgpio_handle = None
+_read = None  # lgpio.gpio_read or gpiod_read, bound in main()
+_h = None  # lgpio chip handle or gpiod line request, bound in main()
+hvac_callback = None
+heartbeat_timer = None
+last_state = (None, None)  # (is_on, raw_value) last seen
+last_tick = None  # lgpio tick (nanoseconds) of the last accepted edge
+kernel_debounce = False  # True if the driver debounces GPIO_HVAC for us
+event_count = 0
+_last_minute = -1  # Minute (epoch // 60) that _minute_prefix was formatted for
+_minute_prefix = ""
+stop_evt = threading.Event()
 
 def read_hvac_state():
     """Read HVAC blower fan state (LOW = on, HIGH = off)"""
-    global gpio_hvac, lgpio_handle
+    raw_value = _read(_h, GPIO_HVAC)
+    return raw_value == 0, raw_value
+
+def gpiod_read(request, offset):
+    """Read a requested line as 0/1, matching lgpio.gpio_read"""
+    return 1 if request.get_value(offset) == Value.ACTIVE else 0
+
+def watch_line_events(request):
+    """Wait on the line request fd and report each settled edge (runs until Ctrl+C)"""
+    global last_state
+    with selectors.DefaultSelector() as sel:
+        sel.register(request.fd, selectors.EVENT_READ)
+        while True:
+            sel.select()
+            for event in request.read_edge_events():
+                level = 1 if event.event_type == event.Type.RISING_EDGE else 0
+                new_state = (level == 0, level)
+                if new_state != last_state:
+                    last_state = new_state
+                    report_state(*last_state)
+
+def format_timestamp():
+    """Return "YYYY-mm-dd HH:MM:SS", reformatting the date part only once per minute"""
+    global _last_minute, _minute_prefix
+    t = int(time.time())
+    minute = t // 60
+    if minute != _last_minute:
+        _minute_prefix = time.strftime("%Y-%m-%d %H:%M:", time.localtime(t))
+        _last_minute = minute
+    return f"{_minute_prefix}{t % 60:02d}"
+
+def report_state(is_on, raw_value, suffix=""):
+    """Print one status line for the given HVAC state"""
+    global event_count
+    event_count += 1
+    timestamp = format_timestamp()
+    sys.stdout.write(_FMT(timestamp, event_count, STATE_LABELS[is_on], RAW_LABELS[raw_value], raw_value, suffix))
+    sys.stdout.flush()
+
+def _on_edge(chip, gpio, level, tick):
+    """lgpio callback for GPIO_HVAC edges (LOW = on, HIGH = off)"""
+    global last_state, last_tick
+    if level not in (0, 1):  # 2 is a watchdog timeout, not a level change
+        return
+    
+    new_state = (level == 0, level)
+    if not kernel_debounce:
+        # Software debounce: drop edges inside the bounce window, then let the
+        # line settle and read the level it actually settled at
+        if last_tick is not None and tick - last_tick < BOUNCE_US * 1000:
+            return
+        last_tick = tick
+        time.sleep(BOUNCE_MS / 1000)
+        new_state = read_hvac_state()
     
-    if gpio_hvac:
-        # Use gpiozero to read
-        # gpiozero: value is 0 for LOW, 1 for HIGH
-        # LOW (0) means HVAC fan is on
-        raw_value = gpio_hvac.value
-        is_on = raw_value == 0
-        return is_on, raw_value
-    elif lgpio_handle is not None:
-        # Use lgpio directly to read
-        import lgpio
-        raw_value = lgpio.gpio_read(lgpio_handle, GPIO_HVAC)
-        is_on = raw_value == 0  # LOW = on
-        return is_on, raw_value
-    return None, None
+    if new_state != last_state:
+        last_state = new_state
+        report_state(*last_state)
+
+def _heartbeat():
+    """Re-print the last known state without reading the pin, then re-arm"""
+    if stop_evt.is_set():
+        return
+    report_state(*last_state, suffix=" (heartbeat)")
+    start_heartbeat()
+
+def start_heartbeat():
+    """Arm the heartbeat timer (no-op if HEARTBEAT_INTERVAL is 0)"""
+    global heartbeat_timer
+    if HEARTBEAT_INTERVAL > 0:
+        heartbeat_timer = threading.Timer(HEARTBEAT_INTERVAL, _heartbeat)
+        heartbeat_timer.daemon = True
+        heartbeat_timer.start()
+
+def stop_heartbeat():
+    """Stop the heartbeat timer (including one that is about to re-arm itself)"""
+    stop_evt.set()
+    if heartbeat_timer is not None:
+        heartbeat_timer.cancel()
 
 def main():
-    global gpio_hvac, lgpio_handle
+    global _read, _h, hvac_callback, last_state, kernel_debounce
     
     print("HVAC Fan State Test Script")
     print("=" * 50)
@@ -61,79 +145,83 @@ def main():
     print("=" * 50)
     print()
     
-    try:
-        # Initialize input device (HVAC state) - no pull resistor
-        print(f"Initializing GPIO{GPIO_HVAC} as input with no pull resistor...")
-        
-        # First, configure the pin using lgpio directly
-        import lgpio
-        handle = lgpio.gpiochip_open(0)
-        
-        # Claim GPIO16 as input
-        lgpio.gpio_claim_input(handle, GPIO_HVAC)
-        
-        # Set GPIO16 to no pull resistor
-        try:
-            lgpio.gpio_set_pull(handle, GPIO_HVAC, lgpio.SET_PULL_NONE)
-            print(f"✓ GPIO{GPIO_HVAC} configured with SET_PULL_NONE via lgpio")
-        except AttributeError:
-            # Try alternative function name if gpio_set_pull doesn't exist
-            try:
-                lgpio.gpio_set_pull_config(handle, GPIO_HVAC, lgpio.SET_PULL_NONE)
-                print(f"✓ GPIO{GPIO_HVAC} configured with SET_PULL_NONE via lgpio (alt method)")
-            except AttributeError:
-                print(f"⚠ Could not set pull resistor - using default configuration")
-        
-        # Now create InputDevice (without pull parameter since lgpio pin factory may not support it)
+    # Cleanup callbacks run in reverse order of registration when the block exits
+    with contextlib.ExitStack() as stack:
+        stack.callback(print, "GPIO cleaned up")
         try:
-            gpio_hvac = InputDevice(GPIO_HVAC)
-            print("✓ InputDevice created successfully")
-        except Exception as e:
-            print(f"✗ Error creating InputDevice: {e}")
-            print("Will use lgpio directly for reading...")
-            gpio_hvac = None
-        
-        # Store handle for direct reading if needed
-        lgpio_handle = handle
-        
-        print()
-        print("Starting monitoring (every 5 seconds)...")
-        print()
-        
-        iteration = 0
-        while True:
-            iteration += 1
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Read the state
-            is_on, raw_value = read_hvac_state()
+            # Initialize input device (HVAC state) - no pull resistor
+            print(f"Initializing GPIO{GPIO_HVAC} as input with no pull resistor...")
             
-            if is_on is not None:
-                status = "ON" if is_on else "OFF"
-                raw_status = f"LOW (0)" if raw_value == 0 else f"HIGH (1)"
-                print(f"[{timestamp}] #{iteration:4d} | State: {status:3s} | Raw: {raw_status:8s} | Pin Value: {raw_value}")
+            if GPIOD_AVAILABLE:
+                # Request the line from the GPIO character device: input, both edges,
+                # no pull resistor, debounced by the kernel
+                settings = gpiod.LineSettings(
+                    direction=Direction.INPUT,
+                    edge_detection=Edge.BOTH,
+                    bias=Bias.DISABLED,
+                    debounce_period=timedelta(milliseconds=BOUNCE_MS),
+                )
+                request = stack.enter_context(
+                    gpiod.request_lines(GPIOD_CHIP, consumer="test_hvac", config={GPIO_HVAC: settings})
+                )
+                kernel_debounce = True
+                print(f"✓ GPIO{GPIO_HVAC} requested from {GPIOD_CHIP} (no pull, {BOUNCE_MS} ms debounce)")
+                _read = gpiod_read
+                _h = request
             else:
-                print(f"[{timestamp}] #{iteration:4d} | Error reading GPIO state")
+                # Configure the pin using lgpio directly
+                handle = lgpio.gpiochip_open(0)
+                stack.callback(lgpio.gpiochip_close, handle)
+                
+                # Claim GPIO16 as input with edge alerts and no pull resistor in one call
+                try:
+                    lgpio.gpio_claim_alert(handle, GPIO_HVAC, lgpio.BOTH_EDGES, lgpio.SET_PULL_NONE)
+                    print(f"✓ GPIO{GPIO_HVAC} configured with SET_PULL_NONE via lgpio")
+                except (AttributeError, TypeError):
+                    # Older lgpio without line flags
+                    lgpio.gpio_claim_alert(handle, GPIO_HVAC, lgpio.BOTH_EDGES)
+                    print(f"⚠ Could not set pull resistor - using default configuration")
+                
+                # Prefer debouncing in the driver, fall back to the check in _on_edge
+                try:
+                    lgpio.gpio_set_debounce_micros(handle, GPIO_HVAC, BOUNCE_US)
+                    kernel_debounce = True
+                    print(f"✓ GPIO{GPIO_HVAC} debounced in driver ({BOUNCE_MS} ms)")
+                except Exception as e:
+                    print(f"⚠ Driver debounce unavailable ({e}), debouncing in software ({BOUNCE_MS} ms)")
+                
+                # Bind the reader once so each read is a single lgpio call
+                _read = lgpio.gpio_read
+                _h = handle
             
-            time.sleep(5)
+            print()
+            print("Waiting for state changes...")
+            print()
             
-    except KeyboardInterrupt:
-        print("\n\nStopped by user")
-    except Exception as e:
-        print(f"\n\nError: {e}")
-        import traceback
-        traceback.print_exc()
-    finally:
-        if 'gpio_hvac' in globals() and gpio_hvac:
-            gpio_hvac.close()
-        if 'lgpio_handle' in globals() and lgpio_handle is not None:
-            try:
-                import lgpio
-                lgpio.gpiochip_close(lgpio_handle)
-            except:
-                pass
-        print("GPIO cleaned up")
+            # Status lines are written and flushed one at a time by report_state()
+            sys.stdout.reconfigure(line_buffering=False)
+            
+            # Print the starting state, then only report edges
+            last_state = read_hvac_state()
+            report_state(*last_state)
+            
+            stack.callback(stop_heartbeat)
+            start_heartbeat()
+            
+            if GPIOD_AVAILABLE:
+                watch_line_events(request)
+            else:
+                hvac_callback = lgpio.callback(handle, GPIO_HVAC, lgpio.BOTH_EDGES, _on_edge)
+                stack.callback(hvac_callback.cancel)
+                
+                # Nothing to do until Ctrl+C; edges are handled on lgpio's callback thread
+                stop_evt.wait()
+                
+        except KeyboardInterrupt:
+            print("\n\nStopped by user")
+        except Exception as e:
+            print(f"\n\nError: {e}")
+            traceback.print_exc()
 
 if __name__ == '__main__':
     main()
-
@@ -1,12 +1,123 @@
 #!/usr/bin/env python3
-import json
+import asyncio
+import base64
+import collections
+import contextlib
 import os
-from pywebpush import webpush, WebPushException
+import random
+import ssl
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+import http_ece
+import httpx
+import orjson
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
 
 VAPID_FILE = 'vapid.json'
 SUBSCRIPTIONS_FILE = 'subscriptions.json'
+PER_ORIGIN_CONCURRENCY = 32  # Max in-flight requests to one push service
+MAX_CONCURRENCY = 200  # Max in-flight requests overall
+MAX_ATTEMPTS = 5  # Tries per subscription when throttled (429) or on 5xx errors
+PROCESS_POOL_MIN_SUBS = 500  # Encrypt in worker processes from this many subscriptions up
+
+def origin_of(endpoint):
+    """Return scheme://host[:port] of a push endpoint"""
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+def b64decode(data):
+    """Decode unpadded base64url, as used for subscription keys"""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def make_signer(private_key):
+    """Return a function mapping an origin to its VAPID headers, signing each origin once"""
+    vapid = Vapid.from_string(private_key)
+    claims = {"sub": "mailto:admin@example.com", "exp": int(time.time()) + 12 * 3600}
+    cache = {}
+
+    def sign(origin):
+        headers = cache.get(origin)
+        if headers is None:
+            headers = cache[origin] = vapid.sign({**claims, "aud": origin})
+        return headers
+
+    return sign
 
-def test_push():
+def encrypt_payload(message, p256dh, auth):
+    """aes128gcm-encrypt message for one subscriber's keys (module level so a process pool can run it)"""
+    return http_ece.encrypt(
+        message,
+        private_key=ec.generate_private_key(ec.SECP256R1()),  # Ephemeral ECDH key per message
+        dh=b64decode(p256dh),
+        auth_secret=b64decode(auth),
+        version="aes128gcm",
+    )
+
+async def build_request(sub, message, sign, pool):
+    """Encrypt message for one subscription and build its request headers"""
+    keys = sub['keys']
+    if pool is None:
+        body = encrypt_payload(message, keys['p256dh'], keys['auth'])
+    else:
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(pool, encrypt_payload, message, keys['p256dh'], keys['auth'])
+    # The JWT only depends on the push service origin, so subscribers share it
+    headers = {
+        **sign(origin_of(sub['endpoint'])),
+        "Content-Encoding": "aes128gcm",
+        "TTL": "0",
+    }
+    return body, headers
+
+async def send_one(client, i, sub, message, sign, pool, expired):
+    """Send to one subscription, backing off on 429/5xx, and print the result as one block"""
+    endpoint = sub.get('endpoint', 'Unknown')
+    lines = [f"\nSubscription {i+1}:", f"Endpoint: {endpoint[:50]}..."]
+
+    try:
+        body, headers = await build_request(sub, message, sign, pool)
+        for attempt in range(MAX_ATTEMPTS):
+            response = await client.post(endpoint, content=body, headers=headers)
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                delay = 2 ** attempt + random.random()
+                lines.append(f"Got {response.status_code}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        
+        if response.status_code in (404, 410):
+            # The browser unsubscribed; drop it so later runs skip it
+            expired.append(sub)
+            lines.append(f"Subscription expired ({response.status_code}), removing it")
+        elif response.status_code >= 400:
+            lines.append(f"WebPush Failed: {response.status_code} {response.reason_phrase}")
+            lines.append(f"Response: {response.text}")
+        else:
+            lines.append(f"Status Code: {response.status_code}")
+            lines.append("Success! Notification sent.")
+    except Exception as e:
+        lines.append(f"General Error: {e}")
+
+    print("\n".join(lines))
+
+async def warm_up(client, origins):
+    """Open a connection to each push service ahead of the sends (responses are ignored)"""
+    await asyncio.gather(*(client.get(f"{origin}/", timeout=5) for origin in origins), return_exceptions=True)
+
+async def send_group(client, group, message, sign, pool, limit, expired):
+    """Send to the subscriptions of one push service, a few at a time"""
+    sem = asyncio.Semaphore(PER_ORIGIN_CONCURRENCY)
+
+    async def send(i, sub):
+        async with sem, limit:
+            await send_one(client, i, sub, message, sign, pool, expired)
+
+    await asyncio.gather(*(send(i, sub) for i, sub in group))
+
+async def test_push():
     print("--- Push Notification Test Script ---")
     
     if not os.path.exists(VAPID_FILE):
@@ -14,8 +125,8 @@ def test_push():
         return
     
     try:
-        with open(VAPID_FILE) as f:
-            vapid_data = json.load(f)
+        with open(VAPID_FILE, 'rb') as f:
+            vapid_data = orjson.loads(f.read())
             private_key = vapid_data.get('privateKey')
             public_key = vapid_data.get('publicKey')
             print(f"VAPID Keys loaded.")
@@ -29,8 +140,8 @@ def test_push():
         return
 
     try:
-        with open(SUBSCRIPTIONS_FILE) as f:
-            subs = json.load(f)
+        with open(SUBSCRIPTIONS_FILE, 'rb') as f:
+            subs = orjson.loads(f.read())
     except Exception as e:
         print(f"Error loading subscriptions: {e}")
         return
@@ -41,29 +152,41 @@ def test_push():
 
     print(f"Found {len(subs)} subscriptions.")
     
-    message = json.dumps({"title": "Server Test", "body": "This is a direct test from the server script."})
+    message = orjson.dumps({"title": "Server Test", "body": "This is a direct test from the server script."})
     
+    # Parse the key and fix the claims (12 hour expiry) once; each origin is signed once
+    sign = make_signer(private_key)
+    
+    # Group subscribers by push service so each origin gets one HTTP/2 connection
+    groups = collections.defaultdict(list)
     for i, sub in enumerate(subs):
-        print(f"\nSubscription {i+1}:")
-        endpoint = sub.get('endpoint', 'Unknown')
-        print(f"Endpoint: {endpoint[:50]}...")
-        
-        try:
-            response = webpush(
-                subscription_info=sub,
-                data=message,
-                vapid_private_key=private_key,
-                vapid_claims={"sub": "mailto:admin@example.com"}
-            )
-            print(f"Status Code: {response.status_code}")
-            print("Success! Notification sent.")
-        except WebPushException as ex:
-            print(f"WebPush Failed: {ex}")
-            if ex.response:
-                print(f"Response: {ex.response.text}")
-        except Exception as e:
-            print(f"General Error: {e}")
+        groups[origin_of(sub.get('endpoint', ''))].append((i, sub))
+    
+    limit = asyncio.Semaphore(MAX_CONCURRENCY)
+    expired = []
+    limits = httpx.Limits(max_connections=len(groups), max_keepalive_connections=len(groups))
+    # Encryption is CPU bound, so spread it over all cores for large lists
+    use_pool = len(subs) >= PROCESS_POOL_MIN_SUBS
+    # One TLS context for the whole run, so TLS sessions can be resumed
+    ssl_ctx = ssl.create_default_context()
+    ssl_ctx.set_alpn_protocols(["h2", "http/1.1"])
+    with ProcessPoolExecutor() if use_pool else contextlib.nullcontext() as pool:
+        async with httpx.AsyncClient(http2=True, limits=limits, verify=ssl_ctx) as client:
+            # DNS, TCP, TLS and HTTP/2 setup happen here, once per origin, before the fanout
+            await warm_up(client, groups)
+            await asyncio.gather(*(send_group(client, group, message, sign, pool, limit, expired) for group in groups.values()))
+    
+    if expired:
+        expired_ids = {id(sub) for sub in expired}
+        live = [sub for sub in subs if id(sub) not in expired_ids]
+        # Write a temp file and swap it in, so an interrupted run never leaves a torn file
+        tmp_path = SUBSCRIPTIONS_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(live, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, SUBSCRIPTIONS_FILE)
+        print(f"\nRemoved {len(expired)} expired subscriptions, {len(live)} remaining.")
 
 if __name__ == "__main__":
-    test_push()
-
+    asyncio.run(test_push())